@@ -11,6 +11,7 @@ Key modifications:
 - Supports additional image types: JPEG, PNG, GIF, BMP, TIFF, WEBP.
 - Cleans the /tmp/downloads/ folder by removing the ZIP file once it is downloaded.
 - Tracks the lifetime number of optimizations performed via a global counter.
+- Optimizes images in parallel across a process pool (one worker per CPU core).
 - Contains documentation for potential new features (see end of file).
 
 Usage:
@@ -21,18 +22,48 @@ import os
 import uuid
 import zipfile
 import tempfile
+import subprocess
 import logging
 import json
+import itertools
 import queue
 import threading
-from flask import Flask, request, send_from_directory, render_template, flash, redirect, Response, stream_with_context
+import time
+import shutil
+import struct
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from flask import Flask, request, send_from_directory, render_template, flash, redirect, Response, stream_with_context, abort, url_for
+from werkzeug.security import safe_join
 from wand.image import Image as WandImage
 from wand.exceptions import WandException
+from wand.resource import limits as magick_limits
+from rq import Queue as TaskQueue
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from tasks import process_images_task, redis_conn, open_sequential
 
 load_dotenv()
 
 MAGICK_HOME = os.getenv("MAGICK_HOME")
 
+# When deployed behind nginx, hand downloads off with X-Accel-Redirect so nginx
+# sends the file itself (see README) instead of streaming it through Python
+USE_X_ACCEL = os.getenv("USE_X_ACCEL", "False").lower() in ("1", "true", "yes")
+
+# Seconds to keep a download handed off to nginx before deleting it
+X_ACCEL_CLEANUP_DELAY = 300
+
+# Hand optimization jobs to the RQ worker (worker.py) instead of running them
+# in a thread of the web process; progress is then polled from /status/<job_id>
+USE_RQ = os.getenv("USE_RQ", "False").lower() in ("1", "true", "yes")
+
+# Time limit for an RQ job in seconds: a fixed allowance plus a budget per
+# archive entry, so that large uploads are not killed by rq's 180 s default
+JOB_TIMEOUT_BASE = int(os.getenv("JOB_TIMEOUT_BASE", 300))
+JOB_TIMEOUT_PER_ENTRY = float(os.getenv("JOB_TIMEOUT_PER_ENTRY", 2))
+task_queue = TaskQueue(connection=redis_conn)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get(
@@ -42,115 +73,403 @@ app.secret_key = os.environ.get(
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-# Global queue for progress updates
-progress_queue = queue.Queue()
+@dataclass
+class JobState:
+    """
+    State of a single optimization job.
+
+    Attributes:
+      - progress_queue: Progress updates for the job's SSE stream; each item is a
+        list (batch) of messages. The queue is bounded so that a stalled or missing
+        SSE client cannot make it grow without limit.
+      - cancel_event: Set when the SSE client goes away before processing is complete.
+      - stream_attached: Set once the job's SSE stream has been opened.
+      - work_dir: Scratch directory holding the uploaded ZIP.
+    """
+    progress_queue: queue.Queue = field(default_factory=lambda: queue.Queue(maxsize=256))
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    stream_attached: threading.Event = field(default_factory=threading.Event)
+    work_dir: str = field(default_factory=tempfile.mkdtemp)
+
+# Registry of running jobs, keyed by job ID
+jobs = {}
+
+# Seconds a job waits for its SSE stream to be opened before it is cancelled
+STREAM_ATTACH_TIMEOUT = 60
+
+# Maximum number of messages per batch / SSE event, and maximum delay before
+# a partial batch is flushed
+BATCH_SIZE = 32
+BATCH_INTERVAL = 0.25
+
+# Supported image file extensions, without the leading dot
+IMAGE_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp'})
 
-# Global variable for tracking output directory and optimization count
-current_output_dir = None
+# Number of images read ahead from the uploaded ZIP while the pool is busy
+PREFETCH_SIZE = 64
+
+# Buffer size for saving the upload, so it is written in few large chunks;
+# the uploaded ZIP is read back through tasks.open_sequential
+IO_BUFFER_SIZE = 1 << 20
+
+# Zip-bomb heuristic: reject entries that expand to more than this many times
+# their compressed size, beyond a small allowance for tiny entries
+MAX_COMPRESSION_RATIO = 100
+COMPRESSION_ALLOWANCE = 1 << 20
+
+# Hard caps on what an upload may expand to, independent of its compression ratio
+MAX_ENTRIES = 10000
+MAX_TOTAL_SIZE = 2 << 30
+
+class ProgressBatcher:
+    """
+    Buffers progress messages and pushes them onto a queue as a single list,
+    flushing once BATCH_SIZE messages are pending or BATCH_INTERVAL seconds
+    have passed since the last flush.
+
+    A flush waits for room in the queue only until it first times out; after
+    that, batches are dropped right away while the queue stays full, so a
+    missing or stalled SSE client cannot hold up processing. Final flushes
+    (wait=True) always wait, so the completion message is not lost lightly.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.stalled = False
+
+    def put(self, message):
+        self.buffer.append(message)
+        if len(self.buffer) >= BATCH_SIZE or time.monotonic() - self.last_flush >= BATCH_INTERVAL:
+            self.flush()
+
+    def flush(self, wait=False):
+        if self.buffer:
+            try:
+                if self.stalled and not wait:
+                    self.target.put_nowait(self.buffer)
+                else:
+                    self.target.put(self.buffer, timeout=30)
+                # The consumer has caught up
+                self.stalled = False
+            except queue.Full:
+                if not self.stalled:
+                    logging.warning("Progress queue full, dropping updates until it drains.")
+                self.stalled = True
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+# Global variable for tracking optimization count
 optimization_count = 0  # Lifetime optimization counter
 
-def optimize_image(input_path, output_path, total_files, current_file, jpeg_quality=85, convert_png=False):
+# Reusable MagickWand handle, created once per worker process
+_worker_image = None
+
+def _get_worker_image():
+    """
+    Return this process's reusable WandImage, creating it on first use.
+    Reusing one MagickWand avoids setting up coder tables and policies per image.
     """
-    Optimize and compress an image file using Wand.
-    Sends progress updates to the global queue.
+    global _worker_image
+    if _worker_image is None:
+        _worker_image = WandImage()
+    return _worker_image
+
+def _init_worker():
+    """
+    Initializer for the image worker processes.
+    Limits OpenMP and ImageMagick to one thread per worker so that os.cpu_count()
+    workers do not oversubscribe the machine, and creates the worker's reusable
+    WandImage. Workers are not pinned to cores: each job starts a pool of its own,
+    so with concurrent jobs the kernel has to be free to move them to idle cores.
+    """
+    os.environ['OMP_NUM_THREADS'] = '1'
+    os.environ['MAGICK_THREAD_LIMIT'] = '1'
+    magick_limits['thread'] = 1
+
+    _get_worker_image()
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def png_has_alpha(data):
+    """
+    Check whether PNG bytes carry transparency without decoding any pixel data.
+    The IHDR colour type tells whether there is an alpha channel (4 = grey + alpha,
+    6 = RGBA); otherwise a tRNS chunk before the first IDAT chunk marks a
+    transparent palette entry or colour.
+    """
+    if len(data) < 26 or data[:8] != PNG_SIGNATURE:
+        return False
+    if data[25] in (4, 6):
+        return True
+
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        if chunk_type == b'tRNS':
+            return True
+        if chunk_type == b'IDAT':
+            return False
+        pos += length + 12
+    return False
+
+def smart_recompress(jpeg_data):
+    """
+    Re-encode JPEG bytes at the lowest quality (40-95) that still reaches an SSIM
+    of 0.9999 against the input, using jpeg-recompress from jpeg-archive.
+    Returns None if jpeg-recompress is unavailable or fails.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'input.jpg')
+        output_path = os.path.join(tmp_dir, 'output.jpg')
+        with open(input_path, 'wb') as f:
+            f.write(jpeg_data)
+
+        try:
+            subprocess.run(["jpeg-recompress", "--quiet", "--target", "0.9999",
+                            "--min", "40", "--max", "95", "--method", "ssim", "--strip",
+                            input_path, output_path],
+                           check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"jpeg-recompress failed, using the fixed JPEG quality: {e}")
+            return None
+
+        with open(output_path, 'rb') as f:
+            return f.read()
+
+def optimize_image(data, file_name, jpeg_quality=85, convert_png=False, smart_quality=False):
+    """
+    Optimize and compress an in-memory image using Wand.
+    Runs inside a worker process, so the result is returned to the caller
+    instead of being pushed onto the progress queue.
     
     Parameters:
-      - input_path: Path of the input image.
-      - output_path: Path where the optimized image will be saved.
-      - total_files: Total number of images being processed.
-      - current_file: The current image index (for progress calculation).
+      - data: Raw bytes of the input image.
+      - file_name: Name of the image inside the uploaded ZIP.
       - jpeg_quality: Quality setting for JPEG images.
       - convert_png: Flag to convert PNG to JPEG if no transparency.
-    """
-    # Calculate and send progress update
-    progress = (current_file / total_files) * 100
-    progress_queue.put({'type': 'progress', 'progress': progress})
+      - smart_quality: Flag to pick the JPEG quality per image by targeting an SSIM score.
 
-    # Get original file size
-    original_size = os.path.getsize(input_path)
+    Returns:
+      A tuple (result, output_name, output_data) where result is a dict with the
+      file name, original/optimized sizes, saving percentage and status, and
+      output_data is None if the image could not be processed.
+    """
+    original_size = len(data)
+    output_name = file_name
     status = "optimized"
 
+    img = _get_worker_image()
     try:
-        with WandImage(filename=input_path) as img:
-            original_format = img.format.upper()
-
-            # Handle PNG conversion if allowed
-            if convert_png and original_format == "PNG":
-                # Check for transparency; Wand uses alpha_channel property
-                if img.alpha_channel:
-                    logging.info(f"Skipping PNG conversion for {input_path} due to transparency.")
-                else:
-                    img.format = "JPEG"
-                    output_path = os.path.splitext(output_path)[0] + ".jpg"
-                    original_format = "JPEG"
-                    status = "converted"
-
-            # Set quality for JPEG
-            if original_format == "JPEG":
-                img.compression_quality = jpeg_quality
-
-            # Save optimized image; note that Wand does not expose an explicit optimize flag
-            img.save(filename=output_path)
+        img.read(blob=data)
+        original_format = img.format.upper()
+
+        # Handle PNG conversion if allowed
+        if convert_png and original_format == "PNG":
+            # Check for transparency from the PNG header rather than the decoded image
+            if png_has_alpha(data):
+                logging.info(f"Skipping PNG conversion for {file_name} due to transparency.")
+            else:
+                img.format = "JPEG"
+                output_name = os.path.splitext(file_name)[0] + ".jpg"
+                original_format = "JPEG"
+                status = "converted"
+
+        # Strip metadata and encode a progressive 4:2:0 JPEG with optimal
+        # Huffman tables (-sampling-factor 4:2:0 -strip -interlace JPEG)
+        if original_format == "JPEG":
+            img.auto_orient()
+            img.strip()
+            img.options['jpeg:sampling-factor'] = '4:2:0'
+            img.options['jpeg:optimize-coding'] = 'true'
+            img.interlace_scheme = 'plane'
+            img.compression_quality = jpeg_quality
+
+        output_data = None
+        if smart_quality and original_format == "JPEG":
+            # Search from a near-lossless encode for the lowest quality that still matches it
+            img.compression_quality = 100
+            output_data = smart_recompress(img.make_blob())
+            img.compression_quality = jpeg_quality
+
+        # Encode optimized image; note that Wand does not expose an explicit optimize flag
+        if output_data is None:
+            output_data = img.make_blob()
 
     except WandException as e:
-        logging.error(f"Error processing {input_path}: {e}")
-        progress_queue.put({
-            'type': 'file_complete',
-            'file_name': os.path.basename(input_path),
+        logging.error(f"Error processing {file_name}: {e}")
+        return {
+            'file_name': os.path.basename(file_name),
             'original_size': original_size,
             'optimized_size': 0,
             'saving_percentage': 0,
             'status': 'error'
-        })
-        return
-
-    # Calculate optimized file size and savings
-    optimized_size = os.path.getsize(output_path)
+        }, output_name, None
+    finally:
+        # Reset the handle (images and options) for the next file
+        img.clear()
+
+    # Keep the original image if re-encoding did not make it smaller
+    optimized_size = len(output_data)
+    if optimized_size >= original_size:
+        output_name = file_name
+        output_data = data
+        optimized_size = original_size
+        status = "kept-original"
+
+    # Calculate savings
     saving_percentage = ((original_size - optimized_size) / original_size) * 100 if original_size > 0 else 0
 
-    # Send file completion update
-    progress_queue.put({
-        'type': 'file_complete',
-        'file_name': os.path.basename(input_path),
+    return {
+        'file_name': os.path.basename(file_name),
         'original_size': original_size,
         'optimized_size': optimized_size,
         'saving_percentage': saving_percentage,
         'status': status
-    })
+    }, output_name, output_data
 
-def process_images(input_dir, output_dir, jpeg_quality, convert_png):
+def process_images(job, zip_in_path, zip_out_path, jpeg_quality, convert_png, smart_quality=False):
     """
-    Process all image files in the input directory and optimize them.
+    Optimize all images in the uploaded ZIP and write them to the output ZIP.
+    Entries are read straight from the input archive and the optimized bytes
+    are written straight into the output archive, so nothing is extracted to disk.
+    Images are optimized in parallel across a process pool; progress updates
+    are pushed to the job's queue as each one finishes. Identical files are
+    optimized only once. The job's scratch directory is removed once
+    processing ends.
     
     Supports file extensions: .jpg, .jpeg, .png, .gif, .bmp, .tiff, .webp.
     """
-    # Set of supported image file extensions
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-    image_files = []
-
-    # Collect all image files from the input directory
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in image_extensions:
-                image_files.append((root, file))
-
-    total_files = len(image_files)
-    for idx, (root, file) in enumerate(image_files, 1):
-        input_path = os.path.join(root, file)
-        rel_path = os.path.relpath(root, input_dir)
-        out_dir = os.path.join(output_dir, rel_path)
-        os.makedirs(out_dir, exist_ok=True)
-        output_path = os.path.join(out_dir, file)
+    updates = ProgressBatcher(job.progress_queue)
+    try:
+        with open_sequential(zip_in_path) as zip_in_file, \
+             zipfile.ZipFile(zip_in_file, 'r') as zip_in, \
+             zipfile.ZipFile(zip_out_path, 'w') as zip_out, \
+             ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as executor:
+            # Collect all image entries from the input archive
+            image_infos = [info for info in zip_in.infolist()
+                           if not info.is_dir()
+                           and info.filename.rpartition('.')[2].lower() in IMAGE_EXTENSIONS]
+
+            total_files = len(image_infos)
+
+            # Identical files (same CRC-32 and size in the central directory) are
+            # optimized once; the result is written under each of their names
+            groups = {}
+            for info in image_infos:
+                groups.setdefault((info.CRC, info.file_size), []).append(info)
+
+            # Entries sharing a pending future, and the input bytes needed to
+            # confirm that a duplicate really is identical
+            future_infos = {}
+
+            def submit(infos):
+                data = zip_in.read(infos[0])
+                future = executor.submit(optimize_image, data, infos[0].filename,
+                                         jpeg_quality, convert_png, smart_quality)
+                future_infos[future] = (infos, data if len(infos) > 1 else None)
+                return future
+
+            # Send roughly 200 progress updates per run regardless of the file count
+            progress_step = max(1, total_files // 200)
+            idx = 0
+
+            def finish(result, output_name, output_data):
+                nonlocal idx
+                idx += 1
+                # Optimized images are already compressed, so store them as-is
+                if output_data is not None:
+                    zip_out.writestr(output_name, output_data, compress_type=zipfile.ZIP_STORED)
+
+                if idx % progress_step == 0 or idx == total_files:
+                    progress = (idx / total_files) * 100
+                    updates.put({'type': 'progress', 'progress': progress})
+                updates.put({'type': 'file_complete', **result})
+
+            # Keep at most PREFETCH_SIZE images in flight so memory stays bounded
+            # while the next entries are already read and queued for the workers
+            remaining = iter(groups.values())
+            pending = {submit(infos) for infos in itertools.islice(remaining, PREFETCH_SIZE)}
+
+            while pending:
+                # Stop early if the progress stream was closed
+                if job.cancel_event.is_set():
+                    for future in pending:
+                        future.cancel()
+                    break
 
-        optimize_image(input_path, output_path, total_files, idx,
-                       jpeg_quality=jpeg_quality, convert_png=convert_png)
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_infos = next(remaining, None)
+                    if next_infos is not None:
+                        pending.add(submit(next_infos))
+
+                    infos, data = future_infos.pop(future)
+                    result, output_name, output_data = future.result()
+                    finish(result, output_name, output_data)
+
+                    for duplicate in infos[1:]:
+                        if zip_in.read(duplicate) != data:
+                            # CRC-32 collision; optimize this one on its own
+                            pending.add(submit([duplicate]))
+                            continue
+                        duplicate_name = duplicate.filename
+                        if output_name != infos[0].filename:
+                            duplicate_name = os.path.splitext(duplicate_name)[0] + os.path.splitext(output_name)[1]
+                        finish({**result, 'file_name': os.path.basename(duplicate.filename)},
+                               duplicate_name, output_data)
+
+        if job.cancel_event.is_set():
+            logging.info("Progress stream closed, discarding partial output.")
+            os.remove(zip_out_path)
+            return
+
+        # Signal that processing is complete
+        updates.put({'type': 'processing_complete', 'zip_file': os.path.basename(zip_out_path)})
+        updates.flush(wait=True)
+    except Exception as e:
+        # A corrupt entry or a crashed worker; tell the client instead of leaving it waiting
+        logging.exception(f"Processing failed: {e}")
+        try:
+            os.remove(zip_out_path)
+        except FileNotFoundError:
+            pass
+        updates.put({'type': 'error', 'message': 'Processing failed. The ZIP file may be corrupt.'})
+        updates.flush(wait=True)
+    finally:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+
+def validate_zip(zip_path, extract_dir):
+    """
+    Scan the central directory of an uploaded ZIP before any entry is read.
+    Returns an error message if the archive is unsafe to process, or None.
 
-    # Signal that processing is complete
-    progress_queue.put({'type': 'processing_complete'})
+    Rejects entries whose path would escape extract_dir (zip-slip), entries
+    whose uncompressed size is out of proportion to their compressed size, and
+    archives with more than MAX_ENTRIES entries or MAX_TOTAL_SIZE bytes in total
+    (zip bombs).
+    """
+    root = os.path.realpath(extract_dir) + os.sep
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+        if len(infos) > MAX_ENTRIES:
+            return f"Too many files in ZIP file (limit {MAX_ENTRIES})"
+
+        total_size = 0
+        for info in infos:
+            destination = os.path.realpath(os.path.join(extract_dir, info.filename))
+            if not destination.startswith(root):
+                return f"Unsafe path in ZIP file: {info.filename}"
+            if info.file_size > MAX_COMPRESSION_RATIO * info.compress_size + COMPRESSION_ALLOWANCE:
+                return f"Suspicious compression ratio in ZIP file: {info.filename}"
+            total_size += info.file_size
+            if total_size > MAX_TOTAL_SIZE:
+                return f"ZIP file expands to more than {MAX_TOTAL_SIZE >> 20} MB"
+    return None
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', use_rq=USE_RQ)
 
 @app.route('/optimize', methods=['POST'])
 def optimize():
@@ -176,68 +495,122 @@ def optimize():
         jpeg_quality = 85
 
     convert_png = bool(request.form.get('convert_png'))
+    smart_quality = bool(request.form.get('smart_quality'))
+    if smart_quality and USE_RQ:
+        # The RQ task re-encodes with Pillow and has no SSIM-targeted quality search
+        return {'status': 'error', 'message': 'Smart JPEG quality is not available with the background worker'}, 400
+    lossless = bool(request.form.get('lossless'))
+    if lossless and not USE_RQ:
+        # Lossless JPEG re-packing (jpegtran) is only implemented in the RQ task
+        return {'status': 'error', 'message': 'Lossless JPEG optimization needs the background worker'}, 400
+
+    # Save the upload to the job's scratch directory; the optimized ZIP is
+    # written straight to the downloads folder
+    downloads_dir = "/tmp/downloads"
+    os.makedirs(downloads_dir, exist_ok=True)
 
-    # Create temporary directories for input and output
-    temp_input_dir = "/tmp/input"
-    temp_output_dir = "/tmp/output"
-    os.makedirs(temp_input_dir, exist_ok=True)
-    os.makedirs(temp_output_dir, exist_ok=True)
-
-    global current_output_dir
-    current_output_dir = temp_output_dir
+    job_id = uuid.uuid4().hex
+    job = JobState()
 
-    zip_path = os.path.join(temp_input_dir, 'upload.zip')
-    file.save(zip_path)
+    zip_path = os.path.join(job.work_dir, 'upload.zip')
+    file.save(zip_path, buffer_size=IO_BUFFER_SIZE)
 
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_input_dir)
+        error = validate_zip(zip_path, job.work_dir)
     except zipfile.BadZipFile:
-        return {'status': 'error', 'message': 'Invalid ZIP file'}, 400
+        error = 'Invalid ZIP file'
+    if error:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        return {'status': 'error', 'message': error}, 400
+
+    if USE_RQ:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            entry_count = len(zip_ref.infolist())
+        job_timeout = JOB_TIMEOUT_BASE + int(JOB_TIMEOUT_PER_ENTRY * entry_count)
+
+        # The worker reads the upload from the job's scratch directory and removes it when done
+        task_queue.enqueue(process_images_task,
+                           args=(zip_path, job_id, jpeg_quality, convert_png),
+                           kwargs={'lossless': lossless, 'cleanup_dir': job.work_dir},
+                           job_id=job_id,
+                           job_timeout=job_timeout)
+        return {'status': 'queued', 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}
+
+    zip_out_path = os.path.join(downloads_dir, f"{job_id}.zip")
+    jobs[job_id] = job
+
+    # Drop the job if the client never opens its progress stream
+    reaper = threading.Timer(STREAM_ATTACH_TIMEOUT, reap_unattached_job, args=(job_id,))
+    reaper.daemon = True
+    reaper.start()
 
     # Start image processing in a separate thread
     thread = threading.Thread(
         target=process_images,
-        args=(temp_input_dir, temp_output_dir, jpeg_quality, convert_png)
+        args=(job, zip_path, zip_out_path, jpeg_quality, convert_png, smart_quality)
     )
     thread.start()
 
-    return {'status': 'success'}
+    return {'status': 'success', 'job_id': job_id}
 
 @app.route('/optimize-stream')
 def optimize_stream():
     """
-    Provides a Server-Sent Events (SSE) stream to send live progress updates.
-    When processing is complete, the optimized images are zipped and the global
-    optimization counter is incremented.
+    Provides a Server-Sent Events (SSE) stream to send live progress updates
+    for the job given by the job_id query parameter.
+    Each event carries a JSON array of one or more update messages.
+    If the client disconnects before processing is complete, processing is cancelled.
+    If processing fails, an error message ends the stream.
+    When processing is complete, the download link for the optimized ZIP is sent
+    and the global optimization counter is incremented.
     """
+    job_id = request.args.get('job_id', '')
+    job = jobs.get(job_id)
+    if job is None:
+        return {'status': 'error', 'message': 'Unknown job'}, 404
+    job.stream_attached.set()
+
     def generate():
-        global optimization_count, current_output_dir
-        while True:
-            try:
-                data = progress_queue.get(timeout=10)
-                if data.get('type') == 'processing_complete':
-                    # Increment lifetime optimization count
-                    optimization_count += 1
-
-                    downloads_dir = "/tmp/downloads"
-                    os.makedirs(downloads_dir, exist_ok=True)
-                    zip_filename = f"{uuid.uuid4().hex}.zip"
-                    zip_file_path = os.path.join(downloads_dir, zip_filename)
-
-                    # Create a ZIP of the optimized images
-                    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
-                        for root, _, files in os.walk(current_output_dir):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                arcname = os.path.relpath(file_path, current_output_dir)
-                                zip_out.write(file_path, arcname)
-
-                    yield f"data: {json.dumps({'type': 'complete', 'zip_file': zip_filename, 'progress': 100})}\n\n"
-                    break
-                yield f"data: {json.dumps(data)}\n\n"
-            except queue.Empty:
-                yield f"data: {json.dumps({'type': 'keepalive'})}\n\n"
+        global optimization_count
+        completed = False
+        try:
+            while True:
+                try:
+                    messages = job.progress_queue.get(timeout=10)
+                except queue.Empty:
+                    yield f"data: {json.dumps([{'type': 'keepalive'}])}\n\n"
+                    continue
+
+                # Drain batches that are already waiting into the same SSE event
+                while len(messages) < BATCH_SIZE:
+                    try:
+                        messages.extend(job.progress_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                events = []
+                for data in messages:
+                    if data.get('type') == 'processing_complete':
+                        # Increment lifetime optimization count
+                        optimization_count += 1
+                        completed = True
+
+                        events.append({'type': 'complete', 'zip_file': data['zip_file'], 'progress': 100})
+                        yield f"data: {json.dumps(events)}\n\n"
+                        return
+                    if data.get('type') == 'error':
+                        # process_images has stopped; nothing left to cancel
+                        completed = True
+                        events.append(data)
+                        yield f"data: {json.dumps(events)}\n\n"
+                        return
+                    events.append(data)
+                yield f"data: {json.dumps(events)}\n\n"
+        finally:
+            # The client disconnected mid-run; tell process_images to stop
+            if not completed:
+                job.cancel_event.set()
+            jobs.pop(job_id, None)
 
     return Response(
         stream_with_context(generate()),
@@ -245,23 +618,99 @@ def optimize_stream():
         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
 
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    """
+    Report the progress of a job handed to the RQ worker, as written to the
+    job's Redis hash by the task. Once the job has finished, the response
+    also carries the URL of its results page.
+    """
+    try:
+        rq_job = Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        return {'status': 'error', 'message': 'Unknown job'}, 404
+
+    if rq_job.is_failed:
+        return {'status': 'error', 'message': 'Optimization failed'}, 500
+
+    fields = redis_conn.hgetall(f"job:{job_id}")
+    status = {
+        'status': rq_job.get_status(),
+        'progress': float(fields.get(b'progress', 0)),
+        'current': int(fields.get(b'current', 0)),
+        'total': int(fields.get(b'total', 0))
+    }
+    if rq_job.is_finished:
+        status['results_url'] = url_for('job_results', job_id=job_id)
+    return status
+
+@app.route('/results/<job_id>')
+def job_results(job_id):
+    """
+    Render the per-file results and the download link of a finished RQ job.
+    """
+    try:
+        rq_job = Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        abort(404)
+    if not rq_job.is_finished:
+        abort(404)
+
+    result = rq_job.return_value()
+    return render_template('results.html', file_info=result['file_info'], zip_file=result['zip_filename'])
+
+def reap_unattached_job(job_id):
+    """
+    Cancel and forget a job whose progress stream was never opened, so that
+    process_images stops and the job's state does not stay in the registry.
+    """
+    job = jobs.get(job_id)
+    if job is not None and not job.stream_attached.is_set():
+        logging.info(f"No progress stream opened for job {job_id}, cancelling it.")
+        job.cancel_event.set()
+        jobs.pop(job_id, None)
+
+def remove_download(file_path):
+    """
+    Remove a downloaded ZIP file from the temporary folder.
+    """
+    try:
+        os.remove(file_path)
+        logging.info(f"Cleaned up downloaded file: {os.path.basename(file_path)}")
+    except Exception as e:
+        logging.error(f"Failed to remove downloaded file {os.path.basename(file_path)}: {e}")
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """
     Serves the ZIP file for download and cleans it up from the temporary folder
     after the download is complete.
+
+    With USE_X_ACCEL set, the response only carries an X-Accel-Redirect header
+    and nginx sends the file; since the transfer then happens after this handler
+    returns, the file is removed after X_ACCEL_CLEANUP_DELAY seconds instead.
     """
     downloads_dir = "/tmp/downloads"
+    file_path = safe_join(downloads_dir, filename)
+
+    if USE_X_ACCEL:
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = Response()
+        response.headers['X-Accel-Redirect'] = f'/internal-downloads/{filename}'
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+        timer = threading.Timer(X_ACCEL_CLEANUP_DELAY, remove_download, args=(file_path,))
+        timer.daemon = True
+        timer.start()
+        return response
+
     response = send_from_directory(downloads_dir, filename, as_attachment=True)
     
     # Schedule deletion of the file once the response is closed
     @response.call_on_close
     def remove_file():
-        try:
-            os.remove(os.path.join(downloads_dir, filename))
-            logging.info(f"Cleaned up downloaded file: {filename}")
-        except Exception as e:
-            logging.error(f"Failed to remove downloaded file {filename}: {e}")
+        remove_download(file_path)
 
     return response
 
@@ -0,0 +1,105 @@
+"""
+image_ops.py - Pillow encoders and header checks shared by the RQ task and the CLI
+"""
+
+import io
+import logging
+import subprocess
+from PIL import Image
+
+# Optional oxipng bindings (pyoxipng) for PNG optimization without Pillow's slow optimize=True
+try:
+    import oxipng
+except ImportError:
+    oxipng = None
+
+# Supported image file extensions, without the leading dot
+IMAGE_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png'})
+
+# Extensions handled by the JPEG-only encoders (jpegtran, TurboJPEG), without the leading dot
+JPEG_EXTENSIONS = frozenset({'jpg', 'jpeg'})
+
+def jpegtran_optimize(data):
+    """Losslessly re-pack JPEG bytes with jpegtran; returns None if jpegtran is unavailable or fails"""
+    try:
+        return subprocess.run(["jpegtran", "-copy", "none", "-optimize", "-progressive"],
+                              input=data, check=True, capture_output=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"jpegtran failed, falling back to Pillow: {e}")
+        return None
+
+def save_jpeg(img, fmt, jpeg_quality):
+    """Encode an image to optimized JPEG bytes"""
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
+    return buf.getvalue()
+
+def save_png(img, fmt, jpeg_quality):
+    """Encode an image to optimized PNG bytes, using a fast zlib pass crunched by oxipng when it is installed"""
+    buf = io.BytesIO()
+    if oxipng is None:
+        img.save(buf, format="PNG", optimize=True)
+        return buf.getvalue()
+    img.save(buf, format="PNG", compress_level=1)
+    return oxipng.optimize_from_memory(buf.getvalue(), level=2)
+
+def save_as_is(img, fmt, jpeg_quality):
+    """Re-save an image in its own format with Pillow's default settings"""
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+# Pillow encoders by format, looked up once per image instead of comparing format names
+SAVERS = {"JPEG": save_jpeg, "PNG": save_png}
+
+# IJG standard luminance quantization table (quality 50), which libjpeg scales by the quality setting
+STD_LUMINANCE_QUANT_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+# PNGs smaller than this are copied as-is; re-encoding them saves next to nothing
+SMALL_PNG_SIZE = 16 * 1024
+
+# Palette PNGs with at most this many colours, stored in at most this fraction of their
+# raw one-byte-per-pixel index data, are already well compressed
+COMPACT_PALETTE_COLORS = 16
+COMPACT_PALETTE_RATIO = 0.25
+
+def is_compact_palette(img, size):
+    """Check from the image header alone whether a palette PNG of size bytes has a small palette and
+    well-compressed pixel data"""
+    # img.palette holds the PLTE chunk as read by Image.open; getpalette() would decode the pixels
+    return (img.palette is not None and len(img.palette.palette) // 3 <= COMPACT_PALETTE_COLORS
+            and size <= COMPACT_PALETTE_RATIO * img.width * img.height)
+
+def estimate_jpeg_quality(quantization):
+    """Estimate the libjpeg quality a JPEG was saved with from its luminance quantization table"""
+    table = quantization.get(0) if quantization else None
+    if not table:
+        return None
+    # libjpeg scales the standard table by 5000/q below quality 50 and by 200-2q above
+    scale = sum(table) * 100 / sum(STD_LUMINANCE_QUANT_TABLE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return round(max(1, min(100, quality)))
+
+def exceeds_max_dim(data, max_dim):
+    """Check from the image header alone whether an image's longest side is larger than max_dim"""
+    with Image.open(io.BytesIO(data)) as img:
+        return max(img.size) > max_dim
+
+def already_optimized(data, jpeg_quality=85, convert_png=False, lossless=False):
+    """Check from the image header alone whether re-encoding can be skipped"""
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format == "JPEG" and not lossless:
+            quality = estimate_jpeg_quality(img.quantization)
+            return quality is not None and quality <= jpeg_quality + 2
+        if img.format == "PNG" and not convert_png:
+            return len(data) < SMALL_PNG_SIZE or (img.mode == "P" and is_compact_palette(img, len(data)))
+    return False
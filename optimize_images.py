@@ -4,37 +4,60 @@ optimize_images.py - CLI tool for image optimization
 """
 
 import argparse
+import io
 import os
 import zipfile
-import tempfile
 from PIL import Image
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from image_ops import (IMAGE_EXTENSIONS, JPEG_EXTENSIONS, SAVERS, already_optimized, exceeds_max_dim,
+                       jpegtran_optimize, save_as_is)
 
-def optimize_image(input_path, output_path, jpeg_quality=85, convert_png=False):
-    """Optimize a single image"""
+def optimize_image(data, file_name, jpeg_quality=85, convert_png=False, lossless=False, max_dim=None):
+    """Optimize (and with max_dim, downscale) a single in-memory image; returns (output_name, output_data),
+    output_data is None on error"""
     try:
-        with Image.open(input_path) as img:
-            original_format = img.format
-            
-            if convert_png and original_format == "PNG":
-                if not (img.mode in ("RGBA", "LA") or 
-                      (img.mode == "P" and "transparency" in img.info)):
-                    img = img.convert("RGB")
-                    output_path = os.path.splitext(output_path)[0] + ".jpg"
-                    original_format = "JPEG"
+        output_name = file_name
+        output_data = None
 
-            if original_format == "JPEG":
-                img.save(output_path, format="JPEG", quality=jpeg_quality, optimize=True)
-            elif original_format == "PNG":
-                img.save(output_path, format="PNG", optimize=True)
-            else:
-                img.save(output_path, format=original_format)
+        needs_resize = max_dim is not None and exceeds_max_dim(data, max_dim)
+
+        # Already at or below the target quality (or too small to gain); ship as-is
+        if not needs_resize and already_optimized(data, jpeg_quality, convert_png, lossless):
+            return file_name, data
+
+        is_jpeg = file_name.rpartition('.')[2].lower() in JPEG_EXTENSIONS
+        # jpegtran cannot resize; images that need downscaling go through Pillow
+        if lossless and is_jpeg and not needs_resize:
+            output_data = jpegtran_optimize(data)
+        if output_data is None:
+            with Image.open(io.BytesIO(data)) as img:
+                original_format = img.format
+
+                if needs_resize:
+                    # thumbnail() calls draft() before the image is first loaded, so libjpeg
+                    # decodes large JPEGs at 1/2, 1/4 or 1/8 scale instead of full resolution
+                    img.thumbnail((max_dim, max_dim))
                 
-        return True
+                if convert_png and original_format == "PNG":
+                    if not (img.mode in ("RGBA", "LA") or 
+                          (img.mode == "P" and "transparency" in img.info)):
+                        img = img.convert("RGB")
+                        output_name = os.path.splitext(file_name)[0] + ".jpg"
+                        original_format = "JPEG"
+
+                output_data = SAVERS.get(original_format, save_as_is)(img, original_format, jpeg_quality)
+
+        # Ship the original file if re-encoding did not make it smaller
+        if not needs_resize and len(output_data) >= len(data):
+            return file_name, data
+                
+        return output_name, output_data
     except Exception as e:
-        print(f"Error processing {input_path}: {e}", file=sys.stderr)
-        return False
+        print(f"Error processing {file_name}: {e}", file=sys.stderr)
+        return file_name, None
 
 def main():
     parser = argparse.ArgumentParser(description='Optimize images in a ZIP file')
@@ -43,53 +66,49 @@ def main():
     parser.add_argument('--quality', type=int, default=85, help='JPEG quality (1-100)')
     parser.add_argument('--convert-png', action='store_true', 
                        help='Convert PNG to JPEG if no transparency')
+    parser.add_argument('--lossless', action='store_true',
+                       help='Losslessly optimize JPEGs with jpegtran instead of re-encoding')
+    parser.add_argument('--max-dim', type=int, default=None,
+                       help='Downscale images so that neither side exceeds this many pixels')
     
     args = parser.parse_args()
     
-    with tempfile.TemporaryDirectory() as temp_input_dir, \
-         tempfile.TemporaryDirectory() as temp_output_dir:
-        
-        # Extract input ZIP
-        print("Extracting input ZIP file...")
-        with zipfile.ZipFile(args.input_zip, 'r') as zip_ref:
-            zip_ref.extractall(temp_input_dir)
+    # Stream entries from the input ZIP straight into the output ZIP, without extracting to disk.
+    # Optimized images are already compressed, so store them without deflating again
+    with zipfile.ZipFile(args.input_zip, 'r') as zip_in, \
+         zipfile.ZipFile(args.output_zip, 'w', zipfile.ZIP_STORED) as zip_out:
+        image_infos = [info for info in zip_in.infolist()
+                       if not info.is_dir() and info.filename.rpartition('.')[2].lower() in IMAGE_EXTENSIONS]
         
-        # Process images
-        image_extensions = {'.jpg', '.jpeg', '.png'}
-        image_files = []
-        
-        for root, _, files in os.walk(temp_input_dir):
-            for file in files:
-                if os.path.splitext(file)[1].lower() in image_extensions:
-                    image_files.append((root, file))
-        
-        print(f"Found {len(image_files)} images to process")
+        print(f"Found {len(image_infos)} images to process")
         
         success_count = 0
-        with tqdm(total=len(image_files), desc="Processing images") as pbar:
-            for root, file in image_files:
-                input_path = os.path.join(root, file)
-                rel_path = os.path.relpath(root, temp_input_dir)
-                out_dir = os.path.join(temp_output_dir, rel_path)
-                os.makedirs(out_dir, exist_ok=True)
-                output_path = os.path.join(out_dir, file)
-                
-                if optimize_image(input_path, output_path, args.quality, args.convert_png):
-                    success_count += 1
-                pbar.update(1)
-        
-        # Create output ZIP
-        print("Creating output ZIP file...")
-        with zipfile.ZipFile(args.output_zip, 'w', zipfile.ZIP_DEFLATED) as zip_out:
-            for root, _, files in os.walk(temp_output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_output_dir)
-                    zip_out.write(file_path, arcname)
+
+        def finish(future):
+            nonlocal success_count
+            output_name, output_data = future.result()
+            if output_data is not None:
+                zip_out.writestr(output_name, output_data)
+                success_count += 1
+            pbar.update(1)
+
+        # Keep at most twice the CPU count of images in flight, so only a window of
+        # the archive is held in memory while the workers are busy
+        depth = 2 * (os.cpu_count() or 1)
+        with tqdm(total=len(image_infos), desc="Processing images") as pbar, \
+             ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pending = deque()
+            for info in image_infos:
+                if len(pending) >= depth:
+                    finish(pending.popleft())
+                pending.append(executor.submit(optimize_image, zip_in.read(info), info.filename, args.quality,
+                                               args.convert_png, args.lossless, args.max_dim))
+            while pending:
+                finish(pending.popleft())
         
-        print(f"\nProcessing complete:")
-        print(f"- Successfully processed: {success_count}/{len(image_files)} images")
-        print(f"- Output saved to: {args.output_zip}")
+    print(f"\nProcessing complete:")
+    print(f"- Successfully processed: {success_count}/{len(image_infos)} images")
+    print(f"- Output saved to: {args.output_zip}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,104 +1,381 @@
+import io
 import os
 import uuid
 import zipfile
 import json
 import logging
-from PIL import Image, UnidentifiedImageError
+import queue
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+import shutil
+from PIL import Image, UnidentifiedImageError, features, __version__ as pillow_version
 import redis
+from rq import get_current_job
+from rq.defaults import DEFAULT_RESULT_TTL
+from image_ops import (IMAGE_EXTENSIONS, JPEG_EXTENSIONS, SAVERS, already_optimized, exceeds_max_dim,
+                       jpegtran_optimize, save_as_is)
 
 # It’s a good idea to set up logging in this module as well
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
+# Optional GPU JPEG encoder (pynvjpeg) used for PNG -> JPEG conversion on CUDA hosts
+try:
+    import numpy as np
+    from nvjpeg import NvJpeg
+except ImportError:
+    NvJpeg = None
+
+# Optional libjpeg-turbo bindings (PyTurboJPEG) for JPEG -> JPEG re-encoding without Pillow
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420, TJFLAG_PROGRESSIVE
+except ImportError:
+    TurboJPEG = None
+
 # If needed, you can import the Redis connection from your configuration
 redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
 redis_conn = redis.from_url(redis_url)
 
-def optimize_image(input_path, output_path, job_id, jpeg_quality=85, convert_png=False):
-    """Optimize single image and update progress in Redis"""
+# Progress is written to Redis at most every BATCH_SIZE images or BATCH_INTERVAL seconds
+BATCH_SIZE = 32
+BATCH_INTERVAL = 0.2
+
+# Seconds a job's progress hash is kept when the task does not run under RQ (or has no timeout)
+PROGRESS_TTL = int(os.environ.get('PROGRESS_TTL', 3600))
+
+def progress_ttl():
+    """Seconds to keep the current job's progress hash: as long as RQ may keep the job itself,
+    i.e. its timeout plus its result TTL"""
+    job = get_current_job()
+    if job is None or not job.timeout or job.timeout < 0:
+        return PROGRESS_TTL
+    result_ttl = job.result_ttl if job.result_ttl is not None and job.result_ttl > 0 else DEFAULT_RESULT_TTL
+    return job.timeout + result_ttl
+
+def publish_progress(job_id, current, total, ttl=PROGRESS_TTL):
+    """Store a job's progress as plain hash fields (expiring after ttl seconds) and announce it on the
+    job's channel, in one round-trip"""
+    progress = (current / total) * 100
+    pipe = redis_conn.pipeline()
+    pipe.hset(f"job:{job_id}", mapping={"progress": progress, "current": current, "total": total})
+    pipe.expire(f"job:{job_id}", int(ttl))
+    pipe.publish(f"job:{job_id}", json.dumps({
+        "type": "progress",
+        "progress": progress,
+        "current": current,
+        "total": total
+    }))
+    pipe.execute()
+
+# nvJPEG encoder state, created on first use and reused for the whole batch
+_gpu_encoder = None
+
+def gpu_encode_jpeg(img, jpeg_quality):
+    """Encode an RGB image to JPEG bytes with nvJPEG; returns None if no GPU encoder is available"""
+    global _gpu_encoder
+    if NvJpeg is None:
+        return None
     try:
-        original_size = os.path.getsize(input_path)
-        
-        with Image.open(input_path) as img:
-            original_format = img.format
-            status = "optimized"
-            
-            if convert_png and original_format == "PNG":
-                if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-                    status = "skipped"
-                else:
-                    img = img.convert("RGB")
-                    output_path = os.path.splitext(output_path)[0] + ".jpg"
-                    original_format = "JPEG"
-                    status = "converted"
-
-            if original_format == "JPEG":
-                img.save(output_path, format="JPEG", quality=jpeg_quality, optimize=True)
-            elif original_format == "PNG":
-                img.save(output_path, format="PNG", optimize=True)
-            else:
-                img.save(output_path, format=original_format)
+        if _gpu_encoder is None:
+            _gpu_encoder = NvJpeg()
+        # nvJPEG expects BGR channel order, like OpenCV
+        return _gpu_encoder.encode(np.ascontiguousarray(np.asarray(img)[:, :, ::-1]), jpeg_quality)
+    except Exception as e:
+        logging.warning(f"nvJPEG encode failed, falling back to Pillow: {e}")
+        return None
+
+def log_pillow_features():
+    """Log whether Pillow's JPEG codec is backed by libjpeg-turbo (as in Pillow-SIMD builds)"""
+    if features.check_feature('libjpeg_turbo'):
+        logging.info(f"Pillow {pillow_version} uses libjpeg-turbo {features.version_feature('libjpeg_turbo')}")
+    else:
+        logging.warning("Pillow is not built against libjpeg-turbo; JPEG encoding will be slower (see README)")
+
+# Read buffer for input archives, so entries are read in few syscalls
+READ_BUFFER_SIZE = 1 << 20
+
+def open_sequential(path):
+    """Open a file for one sequential pass with a large buffer, advising the kernel to read ahead"""
+    f = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
+def drop_from_page_cache(path):
+    """Tell the kernel a file's cached pages will not be needed again"""
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+# TurboJPEG handle, created on first use and reused for the whole batch;
+# False once libturbojpeg failed to load, so that it is not retried per image
+_turbo_jpeg = None
+
+def turbojpeg_optimize(data, jpeg_quality):
+    """Re-encode JPEG bytes with PyTurboJPEG; returns None if it is unavailable or cannot handle the image"""
+    global _turbo_jpeg
+    if TurboJPEG is None or _turbo_jpeg is False:
+        return None
+    if _turbo_jpeg is None:
+        try:
+            _turbo_jpeg = TurboJPEG()
+        except Exception as e:
+            logging.warning(f"libturbojpeg could not be loaded, using Pillow for JPEGs: {e}")
+            _turbo_jpeg = False
+            return None
+    try:
+        # Progressive encoding also gives optimized Huffman tables, like Pillow's optimize=True
+        return _turbo_jpeg.encode(_turbo_jpeg.decode(data), quality=jpeg_quality,
+                                  jpeg_subsample=TJSAMP_420, flags=TJFLAG_PROGRESSIVE)
+    except Exception as e:
+        logging.warning(f"TurboJPEG failed, falling back to Pillow: {e}")
+        return None
+
+def optimize_image(data, file_name, jpeg_quality=85, convert_png=False, lossless=False, max_dim=None,
+                   checked=False):
+    """Optimize (and with max_dim, downscale) a single in-memory image; returns (result, output_name, output_data),
+    output_data is None on error. checked means the caller already found that already_optimized() is False"""
+    original_size = len(data)
+    output_name = file_name
+    status = "optimized"
+
+    try:
+        is_jpeg = file_name.rpartition('.')[2].lower() in JPEG_EXTENSIONS
+        needs_resize = max_dim is not None and exceeds_max_dim(data, max_dim)
+        if not needs_resize and not checked and already_optimized(data, jpeg_quality, convert_png, lossless):
+            # Already at or below the target quality (or too small to gain); ship as-is
+            output_data = data
+            status = "copied"
+        elif needs_resize:
+            # jpegtran and TurboJPEG cannot resize; decode (scaled down) with Pillow instead
+            output_data = None
+        elif is_jpeg and lossless:
+            output_data = jpegtran_optimize(data)
+        elif is_jpeg:
+            output_data = turbojpeg_optimize(data, jpeg_quality)
+        else:
+            output_data = None
+
+        if output_data is None:
+            with Image.open(io.BytesIO(data)) as img:
+                original_format = img.format
+
+                if needs_resize:
+                    # thumbnail() calls draft() before the image is first loaded, so libjpeg
+                    # decodes large JPEGs at 1/2, 1/4 or 1/8 scale instead of full resolution
+                    img.thumbnail((max_dim, max_dim))
+                    status = "resized"
+                
+                if convert_png and original_format == "PNG":
+                    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                        status = "skipped"
+                    else:
+                        img = img.convert("RGB")
+                        output_name = os.path.splitext(file_name)[0] + ".jpg"
+                        original_format = "JPEG"
+                        status = "converted"
+
+                if status == "converted":
+                    output_data = gpu_encode_jpeg(img, jpeg_quality)
+                if output_data is None:
+                    output_data = SAVERS.get(original_format, save_as_is)(img, original_format, jpeg_quality)
+
+        optimized_size = len(output_data)
+        if status != "copied" and not needs_resize and optimized_size >= original_size:
+            # Re-encoding did not help; ship the original image instead
+            output_name = file_name
+            output_data = data
+            optimized_size = original_size
+            status = "kept-original"
 
-        optimized_size = os.path.getsize(output_path)
         saving_percentage = ((original_size - optimized_size) / original_size) * 100 if original_size > 0 else 0
 
         return {
-            "file_name": os.path.basename(input_path),
+            "file_name": os.path.basename(file_name),
             "original_size": original_size,
             "optimized_size": optimized_size,
             "saving_percentage": saving_percentage,
             "status": status
-        }
+        }, output_name, output_data
     except Exception as e:
-        logging.error(f"Error processing {input_path}: {str(e)}")
+        logging.error(f"Error processing {file_name}: {str(e)}")
         return {
-            "file_name": os.path.basename(input_path),
-            "original_size": original_size if 'original_size' in locals() else 0,
+            "file_name": os.path.basename(file_name),
+            "original_size": original_size,
             "optimized_size": 0,
             "saving_percentage": 0,
             "status": "error"
-        }
-
-def process_images_task(input_dir, output_dir, job_id, jpeg_quality, convert_png):
-    """Background task for processing images"""
-    image_extensions = {'.jpg', '.jpeg', '.png'}
-    results = []
-    total_files = sum(1 for root, _, files in os.walk(input_dir) 
-                      for f in files if os.path.splitext(f)[1].lower() in image_extensions)
-    processed = 0
-
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in image_extensions:
-                input_path = os.path.join(root, file)
-                rel_path = os.path.relpath(root, input_dir)
-                out_dir = os.path.join(output_dir, rel_path)
-                os.makedirs(out_dir, exist_ok=True)
-                output_path = os.path.join(out_dir, file)
-                
-                result = optimize_image(input_path, output_path, job_id, jpeg_quality, convert_png)
-                results.append(result)
-                
-                processed += 1
-                progress = (processed / total_files) * 100
-                # Update progress in Redis hash for this job (if needed)
-                redis_conn.hset(f"job:{job_id}", "progress", json.dumps({
-                    "type": "progress",
-                    "progress": progress,
-                    "current": processed,
-                    "total": total_files
-                }))
-
-    # Create ZIP file from the output directory
-    downloads_dir = os.path.join(os.getcwd(), 'downloads')
-    os.makedirs(downloads_dir, exist_ok=True)
-    zip_filename = f"{uuid.uuid4().hex}.zip"
-    zip_path = os.path.join(downloads_dir, zip_filename)
-    
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_out:
-        for root, _, files in os.walk(output_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, output_dir)
-                zip_out.write(file_path, arcname)
-
-    return {"results": results, "zip_filename": zip_filename}
+        }, output_name, None
+
+def pass_through(data, file_name):
+    """Result for an image shipped unchanged, in the form optimize_image returns"""
+    return {
+        "file_name": os.path.basename(file_name),
+        "original_size": len(data),
+        "optimized_size": len(data),
+        "saving_percentage": 0,
+        "status": "copied"
+    }, file_name, data
+
+class FileInfo:
+    """Per-file results of a task, stored column-wise (one list or array per field) instead of one dict per file"""
+    __slots__ = ('file_names', 'original_sizes', 'optimized_sizes', 'statuses')
+
+    def __init__(self):
+        self.file_names = []
+        self.original_sizes = array('q')
+        self.optimized_sizes = array('q')
+        self.statuses = []
+
+    def append(self, result):
+        """Add one result dict as returned by optimize_image"""
+        self.file_names.append(result["file_name"])
+        self.original_sizes.append(result["original_size"])
+        self.optimized_sizes.append(result["optimized_size"])
+        self.statuses.append(result["status"])
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __iter__(self):
+        """Yield (file_name, original_size, optimized_size, saving_percentage, status) rows"""
+        for file_name, original_size, optimized_size, status in zip(
+                self.file_names, self.original_sizes, self.optimized_sizes, self.statuses):
+            if status == "error" or original_size == 0:
+                saving_percentage = 0
+            else:
+                saving_percentage = ((original_size - optimized_size) / original_size) * 100
+            yield file_name, original_size, optimized_size, saving_percentage, status
+
+# Process pool shared by all tasks of a long-running worker (set by worker.py);
+# when it is None, each task starts and shuts down a pool of its own
+POOL = None
+
+# Images in flight between the reader, the worker pool and the ZIP writer (0 = twice the CPU count)
+PIPELINE_DEPTH = int(os.environ.get('PIPELINE_DEPTH', 0))
+
+def process_images_task(zip_in_path, job_id, jpeg_quality, convert_png, lossless=False, max_dim=None,
+                        cleanup_dir=None):
+    """Background task for processing images; entries are streamed from the input ZIP into the output ZIP.
+    cleanup_dir (e.g. the web app's upload directory) is removed once the task ends"""
+    global POOL
+    zip_path = None
+    finished = False
+    try:
+        file_info = FileInfo()
+        # RQ tracks the current job per thread, so look up the TTL before the writer thread starts
+        ttl = progress_ttl()
+
+        # Same folder the web app serves /download/<filename> from
+        downloads_dir = "/tmp/downloads"
+        os.makedirs(downloads_dir, exist_ok=True)
+        zip_filename = f"{uuid.uuid4().hex}.zip"
+        zip_path = os.path.join(downloads_dir, zip_filename)
+
+        # Entries are read, optimized and written in overlapping stages; at most
+        # PIPELINE_DEPTH images are in flight and queued for the writer at once
+        depth = PIPELINE_DEPTH or 2 * (os.cpu_count() or 1)
+        write_queue = queue.Queue(maxsize=depth)
+        writer_errors = []
+
+        # Optimized images are already compressed, so store them without deflating again
+        with open_sequential(zip_in_path) as fp, \
+             zipfile.ZipFile(fp, 'r') as zip_in, \
+             zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_out:
+            image_infos = [info for info in zip_in.infolist()
+                           if not info.is_dir() and info.filename.rpartition('.')[2].lower() in IMAGE_EXTENSIONS]
+            total_files = len(image_infos)
+
+            def write_entries():
+                """Writer stage: ZipFile is not thread-safe, so a single thread appends entries and reports progress"""
+                processed = 0
+                unpublished = 0
+                last_publish = time.monotonic()
+                while True:
+                    item = write_queue.get()
+                    if item is None:
+                        break
+                    if writer_errors:
+                        # Keep draining so the reader never blocks on a full queue
+                        continue
+                    try:
+                        result, output_name, output_data = item
+                        if output_data is not None:
+                            zip_out.writestr(output_name, output_data)
+                        file_info.append(result)
+                        
+                        processed += 1
+                        unpublished += 1
+                        now = time.monotonic()
+                        if unpublished >= BATCH_SIZE or now - last_publish >= BATCH_INTERVAL or processed == total_files:
+                            publish_progress(job_id, processed, total_files, ttl)
+                            unpublished = 0
+                            last_publish = now
+                    except Exception as e:
+                        writer_errors.append(e)
+
+            writer = threading.Thread(target=write_entries, daemon=True)
+            writer.start()
+            try:
+                # Reader stage: this thread reads entries and feeds the worker pool,
+                # handing finished images to the writer in archive order
+                # A shared pool outlives the task, so only a task-local pool is shut down here
+                pool = nullcontext(POOL) if POOL is not None else ProcessPoolExecutor(max_workers=os.cpu_count())
+                with pool as executor:
+                    pending = deque()
+                    for info in image_infos:
+                        if len(pending) >= depth:
+                            write_queue.put(pending.popleft().result())
+                        data = zip_in.read(info)
+                        try:
+                            copy = max_dim is None and already_optimized(data, jpeg_quality, convert_png, lossless)
+                        except Exception:
+                            # Unreadable header; leave it to the worker to report the error
+                            copy = False
+                        if copy:
+                            # Already optimized; hand the raw bytes straight to the writer
+                            # instead of sending them through the pool and back
+                            future = Future()
+                            future.set_result(pass_through(data, info.filename))
+                        else:
+                            # The header was checked above, so the worker does not parse it again
+                            future = executor.submit(optimize_image, data, info.filename, jpeg_quality,
+                                                     convert_png, lossless, max_dim, checked=max_dim is None)
+                        pending.append(future)
+                    while pending:
+                        write_queue.put(pending.popleft().result())
+            finally:
+                write_queue.put(None)
+                writer.join()
+            if writer_errors:
+                raise writer_errors[0]
+
+        # The upload is never read again; leave the page cache to other jobs
+        drop_from_page_cache(zip_in_path)
+        finished = True
+    except BrokenProcessPool:
+        # A pool worker died (e.g. killed for running out of memory); replace the
+        # shared pool so that later jobs do not fail with it
+        if POOL is not None:
+            logging.warning("Process pool broke, starting a new one")
+            POOL.shutdown(wait=False)
+            POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+        raise
+    finally:
+        if not finished and zip_path is not None:
+            # Nothing serves or deletes a partial archive, so do not leave it in the downloads folder
+            try:
+                os.remove(zip_path)
+            except FileNotFoundError:
+                pass
+        if cleanup_dir:
+            shutil.rmtree(cleanup_dir, ignore_errors=True)
+
+    return {"file_info": file_info, "zip_filename": zip_filename}
@@ -2,70 +2,199 @@
 """
 test_image_optimizer.py
 
-Unit tests for the image_optimizer functions in app.py.
+Unit tests for the upload checks and duplicate handling in app.py, and for the
+helpers shared by the background task and the CLI (image_ops.py, tasks.py).
 Run these tests with:
     python -m unittest tests/test_image_optimizer.py
+
+The app.py tests need Wand (and ImageMagick) and are skipped without them.
 """
 
+import io
 import os
+import random
 import tempfile
 import unittest
+import zipfile
+from unittest import mock
 from PIL import Image
-from app import optimize_image, crawl_and_optimize
 
-class TestImageOptimizer(unittest.TestCase):
+from image_ops import SMALL_PNG_SIZE, already_optimized, estimate_jpeg_quality, save_png
+from tasks import FileInfo
+
+try:
+    import app
+except ImportError:
+    app = None
+
+def image_bytes(mode="RGB", size=(64, 64), fmt="PNG", noise=False, **params):
+    """Helper to encode a simple (or, with noise, hard to compress) image to bytes."""
+    img = Image.new(mode, size, (255, 0, 0, 128)[:len(mode)] if mode != "P" else 1)
+    if noise:
+        rng = random.Random(0)
+        img = Image.frombytes(mode, size, rng.randbytes(size[0] * size[1] * len(mode)))
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+@unittest.skipIf(app is None, "Wand is not installed")
+class TestValidateZip(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.tmp_dir.name, "upload.zip")
+        self.extract_dir = os.path.join(self.tmp_dir.name, "extract")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_zip(self, entries, compression=zipfile.ZIP_STORED):
+        with zipfile.ZipFile(self.zip_path, "w", compression) as zf:
+            for name, data in entries.items():
+                zf.writestr(name, data)
+
+    def test_accepts_plain_archive(self):
+        self.write_zip({"a.jpg": b"x" * 100, "sub/b.png": b"y" * 100})
+        self.assertIsNone(app.validate_zip(self.zip_path, self.extract_dir))
+
+    def test_rejects_zip_slip(self):
+        self.write_zip({"../evil.png": b"x"})
+        self.assertIn("Unsafe path", app.validate_zip(self.zip_path, self.extract_dir))
+
+    def test_rejects_absolute_path(self):
+        with zipfile.ZipFile(self.zip_path, "w") as zf:
+            info = zipfile.ZipInfo("evil.png")
+            # writestr() strips a leading slash from a plain name, so set it on the entry directly
+            info.filename = "/etc/evil.png"
+            zf.writestr(info, b"x")
+        self.assertIn("Unsafe path", app.validate_zip(self.zip_path, self.extract_dir))
+
+    def test_rejects_compression_ratio(self):
+        self.write_zip({"bomb.png": b"\0" * (4 << 20)}, zipfile.ZIP_DEFLATED)
+        self.assertIn("compression ratio", app.validate_zip(self.zip_path, self.extract_dir))
+
+    def test_rejects_entry_count(self):
+        self.write_zip({f"{i}.png": b"x" for i in range(4)})
+        with mock.patch.object(app, "MAX_ENTRIES", 3):
+            self.assertIn("Too many files", app.validate_zip(self.zip_path, self.extract_dir))
+
+    def test_rejects_total_size(self):
+        self.write_zip({"a.png": b"x" * 600, "b.png": b"x" * 600})
+        with mock.patch.object(app, "MAX_TOTAL_SIZE", 1000):
+            self.assertIn("expands to more than", app.validate_zip(self.zip_path, self.extract_dir))
+
+@unittest.skipIf(app is None, "Wand is not installed")
+class TestPngHasAlpha(unittest.TestCase):
+    def test_rgb_is_opaque(self):
+        self.assertFalse(app.png_has_alpha(image_bytes("RGB")))
+
+    def test_rgba_colour_type(self):
+        self.assertTrue(app.png_has_alpha(image_bytes("RGBA")))
+
+    def test_grey_alpha_colour_type(self):
+        self.assertTrue(app.png_has_alpha(image_bytes("LA")))
+
+    def test_palette_with_trns(self):
+        self.assertTrue(app.png_has_alpha(image_bytes("P", transparency=0)))
+
+    def test_palette_without_trns(self):
+        self.assertFalse(app.png_has_alpha(image_bytes("P")))
+
+    def test_rgb_with_trns(self):
+        self.assertTrue(app.png_has_alpha(image_bytes("RGB", transparency=(255, 0, 0))))
+
+    def test_not_a_png(self):
+        self.assertFalse(app.png_has_alpha(image_bytes("RGB", fmt="JPEG")))
+
+@unittest.skipIf(app is None, "Wand is not installed")
+class TestDuplicateEntries(unittest.TestCase):
     def setUp(self):
-        # Create temporary directories for input and output.
-        self.input_dir = tempfile.TemporaryDirectory()
-        self.output_dir = tempfile.TemporaryDirectory()
+        self.job = app.JobState()
+        self.zip_in_path = os.path.join(self.job.work_dir, "upload.zip")
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.zip_out_path = os.path.join(self.out_dir.name, "optimized.zip")
 
     def tearDown(self):
-        self.input_dir.cleanup()
-        self.output_dir.cleanup()
-
-    def create_test_image(self, path, mode="RGB", size=(100, 100), color=(255, 0, 0), fmt="JPEG"):
-        """Helper to create a simple image file."""
-        img = Image.new(mode, size, color)
-        img.save(path, format=fmt)
-
-    def test_optimize_jpeg(self):
-        input_path = os.path.join(self.input_dir.name, "test.jpg")
-        self.create_test_image(input_path, fmt="JPEG")
-        output_path = os.path.join(self.output_dir.name, "test.jpg")
-        optimize_image(input_path, output_path, jpeg_quality=50)
-        self.assertTrue(os.path.exists(output_path), "Optimized JPEG should exist.")
-
-    def test_optimize_png(self):
-        input_path = os.path.join(self.input_dir.name, "test.png")
-        self.create_test_image(input_path, fmt="PNG")
-        output_path = os.path.join(self.output_dir.name, "test.png")
-        optimize_image(input_path, output_path)
-        self.assertTrue(os.path.exists(output_path), "Optimized PNG should exist.")
-
-    def test_convert_png_to_jpeg_without_transparency(self):
-        input_path = os.path.join(self.input_dir.name, "test.png")
-        self.create_test_image(input_path, mode="RGB", fmt="PNG")
-        output_path = os.path.join(self.output_dir.name, "test.png")
-        optimize_image(input_path, output_path, convert_png=True, jpeg_quality=70)
-        expected_output = os.path.splitext(output_path)[0] + ".jpg"
-        self.assertTrue(os.path.exists(expected_output), "Converted JPEG file should exist.")
-
-    def test_skip_convert_png_with_transparency(self):
-        input_path = os.path.join(self.input_dir.name, "test.png")
-        self.create_test_image(input_path, mode="RGBA", fmt="PNG")
-        output_path = os.path.join(self.output_dir.name, "test.png")
-        optimize_image(input_path, output_path, convert_png=True, jpeg_quality=70)
-        self.assertTrue(os.path.exists(output_path), "Optimized PNG should exist.")
-        expected_jpeg = os.path.splitext(output_path)[0] + ".jpg"
-        self.assertFalse(os.path.exists(expected_jpeg), "PNG with transparency should not be converted to JPEG.")
-
-    def test_non_image_file(self):
-        input_path = os.path.join(self.input_dir.name, "not_an_image.txt")
-        with open(input_path, "w") as f:
-            f.write("This is not an image.")
-        output_path = os.path.join(self.output_dir.name, "not_an_image.txt")
-        optimize_image(input_path, output_path)
-        self.assertFalse(os.path.exists(output_path), "Non-image files should not produce output.")
-
-if __name__ == '__main__':
+        self.out_dir.cleanup()
+
+    def process(self, entries, convert_png=False):
+        with zipfile.ZipFile(self.zip_in_path, "w") as zf:
+            for name, data in entries.items():
+                zf.writestr(name, data)
+        app.process_images(self.job, self.zip_in_path, self.zip_out_path, 85, convert_png)
+        messages = []
+        while not self.job.progress_queue.empty():
+            messages.extend(self.job.progress_queue.get_nowait())
+        with zipfile.ZipFile(self.zip_out_path) as zf:
+            return zf.namelist(), messages
+
+    def test_duplicates_written_once_per_name(self):
+        data = image_bytes("RGB", (128, 128), fmt="JPEG", noise=True, quality=100)
+        names, messages = self.process({"a/one.jpg": data, "b/two.jpg": data, "other.jpg": image_bytes(fmt="JPEG")})
+        self.assertEqual(sorted(names), ["a/one.jpg", "b/two.jpg", "other.jpg"])
+        completed = [m["file_name"] for m in messages if m["type"] == "file_complete"]
+        self.assertEqual(sorted(completed), ["one.jpg", "other.jpg", "two.jpg"])
+
+    def test_duplicates_renamed_on_conversion(self):
+        data = image_bytes("RGB", (128, 128), noise=True)
+        names, _ = self.process({"a/one.png": data, "b/TWO.PNG": data}, convert_png=True)
+        self.assertEqual(sorted(names), ["a/one.jpg", "b/TWO.jpg"])
+
+class TestEstimateJpegQuality(unittest.TestCase):
+    def test_ijg_tables(self):
+        for quality in (50, 85, 95):
+            with self.subTest(quality=quality):
+                data = image_bytes("RGB", fmt="JPEG", quality=quality)
+                with Image.open(io.BytesIO(data)) as img:
+                    self.assertEqual(estimate_jpeg_quality(img.quantization), quality)
+
+    def test_missing_table(self):
+        self.assertIsNone(estimate_jpeg_quality(None))
+        self.assertIsNone(estimate_jpeg_quality({}))
+
+class TestAlreadyOptimized(unittest.TestCase):
+    def palette_png(self, **params):
+        img = Image.new("RGB", (1200, 1200))
+        rng = random.Random(0)
+        for _ in range(5000):
+            x, y = rng.randrange(1180), rng.randrange(1180)
+            img.paste((rng.randrange(4) * 80, rng.randrange(2) * 200, 100),
+                      (x, y, x + rng.randrange(1, 20), y + rng.randrange(1, 20)))
+        buf = io.BytesIO()
+        img.quantize(8).save(buf, format="PNG", **params)
+        return buf.getvalue()
+
+    def test_compact_palette_png_is_copied(self):
+        data = self.palette_png(optimize=True)
+        self.assertGreater(len(data), SMALL_PNG_SIZE)
+        self.assertTrue(already_optimized(data))
+
+    def test_poorly_compressed_palette_png_is_reencoded(self):
+        data = self.palette_png(compress_level=0)
+        self.assertGreater(len(data), SMALL_PNG_SIZE)
+        self.assertFalse(already_optimized(data))
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertLess(len(save_png(img, "PNG", 85)), len(data) // 10)
+
+    def test_small_png_is_copied(self):
+        self.assertTrue(already_optimized(image_bytes("RGB")))
+
+class TestFileInfo(unittest.TestCase):
+    def test_rows(self):
+        file_info = FileInfo()
+        file_info.append({"file_name": "a.jpg", "original_size": 200, "optimized_size": 50, "status": "optimized"})
+        file_info.append({"file_name": "b.png", "original_size": 100, "optimized_size": 0, "status": "error"})
+        file_info.append({"file_name": "c.png", "original_size": 0, "optimized_size": 0, "status": "kept-original"})
+        self.assertEqual(len(file_info), 3)
+        self.assertEqual(list(file_info), [
+            ("a.jpg", 200, 50, 75.0, "optimized"),
+            ("b.png", 100, 0, 0, "error"),
+            ("c.png", 0, 0, 0, "kept-original"),
+        ])
+
+    def test_rows_can_be_iterated_twice(self):
+        file_info = FileInfo()
+        file_info.append({"file_name": "a.jpg", "original_size": 10, "optimized_size": 10, "status": "kept-original"})
+        self.assertEqual(list(file_info), list(file_info))
+
+if __name__ == "__main__":
     unittest.main()
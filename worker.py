@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import os
 import redis
-from rq import Worker, Queue, connections
+from concurrent.futures import ProcessPoolExecutor
+from rq import SimpleWorker, Queue
+import tasks
+from tasks import log_pillow_features
 
 listen = ['default']
 
@@ -9,6 +12,10 @@ redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
 if __name__ == '__main__':
-    with connections(conn):
-        worker = Worker(list(map(Queue, listen)))
-        worker.work()
+    log_pillow_features()
+    # Jobs run in this process instead of a forked work horse per job, so every
+    # job reuses one process pool rather than paying its startup cost again
+    tasks.POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+    queues = [Queue(name, connection=conn) for name in listen]
+    worker = SimpleWorker(queues, connection=conn)
+    worker.work()